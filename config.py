@@ -13,9 +13,14 @@ ERROR_DIR = BASE_DIR / "error"
 LOG_DIR = BASE_DIR / "logs"
 TEMP_DIR = BASE_DIR / "temp"
 
-# Create directories if they don't exist
-for directory in [INPUT_DIR, OUTPUT_DIR, PROCESSED_DIR, ERROR_DIR, LOG_DIR, TEMP_DIR]:
-    directory.mkdir(exist_ok=True)
+# The log directory must exist on import: utils.logger opens LOGGING_CONFIG['file']
+# as soon as it is imported, before main() calls ensure_dirs()
+LOG_DIR.mkdir(exist_ok=True)
+
+def ensure_dirs():
+    """Create the working directories if they don't exist (called once at startup, not on import)"""
+    for directory in [INPUT_DIR, OUTPUT_DIR, PROCESSED_DIR, ERROR_DIR, TEMP_DIR]:
+        directory.mkdir(exist_ok=True)
 
 # File extensions supported
 SUPPORTED_EXTENSIONS = {
@@ -45,7 +50,8 @@ EMAIL_CONFIG = {
     'smtp_server': 'smtp.gmail.com',
     'smtp_port': 587,
     'sender_email': 'gmail id',  # Replace with your Gmail address
-    'sender_password': 'gmail app password'   # Replace with your Gmail app password
+    'sender_password': 'gmail app password',   # Replace with your Gmail app password
+    'max_connections': 4  # Parallel IMAP connections for downloads (Gmail allows up to 15)
 }
 
 # Processing Configuration
@@ -3,50 +3,377 @@ Gmail Invoice Downloader for RPA System
 Downloads invoice attachments from Gmail and saves them to input directory
 """
 import os
-import email
+import binascii
+import hashlib
+import json
+import quopri
+import select
 import imaplib
+import ssl
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+from email.header import decode_header
+from email.parser import BytesHeaderParser
+from email.utils import collapse_rfc2231_value, decode_params, unquote
 from pathlib import Path
 import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 import time
+import threading
 
 from utils.logger import logger
 from utils.exceptions import EmailError, NetworkError
 from config import EMAIL_CONFIG, INPUT_DIR
 
+# Messages per FETCH command; keeps the message set below server request limits
+FETCH_BATCH_SIZE = 100
+
+# Header-only parser: stops at the header/body boundary instead of building a MIME tree
+_HEADER_PARSER = BytesHeaderParser()
+
+# Messages per STORE command when flagging emails as read
+STORE_BATCH_SIZE = 500
+
+# Encoded bytes decoded per write when streaming attachments to disk
+DECODE_CHUNK_SIZE = 64 * 1024
+
+# Write buffer for the download manifest (one JSON line per attachment)
+MANIFEST_BUFFER_SIZE = 64 * 1024
+
+# Gmail's per-account limit on simultaneous IMAP connections
+GMAIL_MAX_CONNECTIONS = 15
+
+# Re-issue IDLE before servers drop it (RFC 2177 recommends under 29 minutes)
+IDLE_TIMEOUT = 29 * 60
+
+# Filename sanitization patterns for email subjects
+_UNSAFE_CHARS_RE = re.compile(r'[^\w\s-]')
+_SEPARATORS_RE = re.compile(r'[-\s]+')
+
+
+def _chunked(items: List, size: int):
+    """Yield consecutive slices of at most size items"""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _message_set(email_ids: List) -> str:
+    """Join message UIDs into an IMAP message set ("1,2,3")"""
+    return ','.join(i.decode() if isinstance(i, bytes) else str(i) for i in email_ids)
+
+
+def _parse_imap_list(raw: bytes) -> List:
+    """Parse IMAP response text into nested lists of atoms and strings"""
+    stack = [[]]
+    pos = 0
+    length = len(raw)
+    
+    while pos < length:
+        char = raw[pos:pos + 1]
+        
+        if char in (b' ', b'\r', b'\n'):
+            pos += 1
+        elif char == b'(':
+            stack.append([])
+            pos += 1
+        elif char == b')':
+            if len(stack) > 1:
+                item = stack.pop()
+                stack[-1].append(item)
+            pos += 1
+        elif char == b'"':
+            # Quoted string with backslash escapes
+            value = bytearray()
+            pos += 1
+            while pos < length and raw[pos:pos + 1] != b'"':
+                if raw[pos:pos + 1] == b'\\':
+                    pos += 1
+                value += raw[pos:pos + 1]
+                pos += 1
+            stack[-1].append(bytes(value))
+            pos += 1
+        elif char == b'{':
+            # Literal: {size} immediately followed by size bytes
+            end = raw.index(b'}', pos)
+            size = int(raw[pos + 1:end])
+            pos = end + 1
+            stack[-1].append(raw[pos:pos + size])
+            pos += size
+        else:
+            # Atom; section specifiers like BODY[HEADER.FIELDS (SUBJECT)] stay whole
+            end = pos
+            depth = 0
+            while end < length:
+                char = raw[end:end + 1]
+                if char == b'[':
+                    depth += 1
+                elif char == b']':
+                    depth -= 1
+                elif depth == 0 and char in (b' ', b'(', b')', b'\r', b'\n'):
+                    break
+                end += 1
+            atom = raw[pos:end]
+            stack[-1].append(None if atom.upper() == b'NIL' else atom)
+            pos = end
+    
+    while len(stack) > 1:
+        item = stack.pop()
+        stack[-1].append(item)
+    
+    return stack[0]
+
+
+def _parse_fetch_response(msg_data: List) -> Dict[bytes, Dict[str, Any]]:
+    """Map each message UID in a UID FETCH response to its data items"""
+    # imaplib splits literals into (prefix, literal) tuples; rejoin them in order
+    chunks = []
+    for item in msg_data:
+        if isinstance(item, tuple):
+            chunks.append(item[0] + item[1])
+        elif item:
+            chunks.append(item)
+    
+    tokens = _parse_imap_list(b' '.join(chunks))
+    messages = {}
+    
+    for msg_id, attributes in zip(tokens[::2], tokens[1::2]):
+        if not isinstance(msg_id, bytes) or not isinstance(attributes, list):
+            continue
+        
+        items = {}
+        for key, value in zip(attributes[::2], attributes[1::2]):
+            if isinstance(key, bytes):
+                items[key.decode('ascii', errors='replace').upper()] = value
+        
+        # Sequence numbers lead each response; unsolicited updates without a UID are skipped
+        if isinstance(items.get('UID'), bytes):
+            messages[items['UID']] = items
+    
+    return messages
+
+
+def _get_section_literal(msg_data: List, email_id: Any, section: str) -> bytes:
+    """Return the BODY[section] literal for one UID straight from a UID FETCH response
+    
+    Avoids _parse_fetch_response, whose joins and slices would copy a large attachment several times.
+    """
+    uid = email_id if isinstance(email_id, bytes) else str(email_id).encode()
+    section_re = re.compile(rb'BODY\[' + re.escape(section.encode()) + rb'\](?:<\d+>)? \{\d+\}$', re.IGNORECASE)
+    uid_re = re.compile(rb'\bUID (\d+)', re.IGNORECASE)
+    
+    for index, item in enumerate(msg_data):
+        if not isinstance(item, tuple) or not section_re.search(item[0]):
+            continue
+        
+        # The UID item may come before the literal or in the text that follows it
+        trailing = msg_data[index + 1] if index + 1 < len(msg_data) and isinstance(msg_data[index + 1], bytes) else b''
+        match = uid_re.search(item[0]) or uid_re.search(trailing)
+        if match and match.group(1) == uid:
+            return item[1]
+    
+    return b''
+
+
+def _get_header_section(items: Dict[str, Any]) -> bytes:
+    """Return the BODY[HEADER...] literal from parsed FETCH data items"""
+    for key, value in items.items():
+        if key.startswith('BODY[HEADER') and isinstance(value, bytes):
+            return value
+    return b''
+
+
+def _decode_header_value(value: str) -> str:
+    """Decode RFC 2047 encoded words in a header value"""
+    decoded = []
+    for chunk, charset in decode_header(value or ''):
+        if isinstance(chunk, bytes):
+            try:
+                chunk = chunk.decode(charset or 'utf-8', errors='replace')
+            except LookupError:
+                chunk = chunk.decode('utf-8', errors='replace')
+        decoded.append(chunk)
+    return ''.join(decoded)
+
+
+def _iter_body_parts(structure: List, section: str = ''):
+    """Yield (section, part) for every non-multipart part of a BODYSTRUCTURE"""
+    if not isinstance(structure, list) or not structure:
+        return
+    
+    if isinstance(structure[0], list):
+        # Multipart: child parts come first, followed by the subtype
+        for index, child in enumerate(structure, 1):
+            if not isinstance(child, list):
+                break
+            yield from _iter_body_parts(child, f"{section}.{index}" if section else str(index))
+        return
+    
+    yield section or '1', structure
+    
+    # Descend into forwarded messages (message/rfc822 carries a nested body at index 8)
+    if _part_type(structure) == 'message/rfc822' and len(structure) > 8:
+        nested = structure[8]
+        if isinstance(nested, list) and nested and not isinstance(nested[0], list):
+            yield from _iter_body_parts(nested, f"{section or '1'}.1")
+        else:
+            yield from _iter_body_parts(nested, section or '1')
+
+
+def _part_type(part: List) -> str:
+    """Return the lowercase content type of a BODYSTRUCTURE part"""
+    maintype = part[0] if isinstance(part[0], bytes) else b''
+    subtype = part[1] if len(part) > 1 and isinstance(part[1], bytes) else b''
+    return f"{maintype.decode(errors='replace')}/{subtype.decode(errors='replace')}".lower()
+
+
+def _part_encoding(part: List) -> str:
+    """Return the lowercase Content-Transfer-Encoding of a BODYSTRUCTURE part"""
+    encoding = part[5] if len(part) > 5 and isinstance(part[5], bytes) else b'7bit'
+    return encoding.decode(errors='replace').lower()
+
+
+def _part_size(part: List) -> int:
+    """Return the encoded size in bytes of a BODYSTRUCTURE part"""
+    try:
+        return int(part[6])
+    except (IndexError, TypeError, ValueError):
+        return 0
+
+
+def _write_part_payload(file, payload: bytes, encoding: str):
+    """Decode a raw BODY[section] payload into an open binary file"""
+    if encoding == 'quoted-printable':
+        file.write(quopri.decodestring(payload))
+        return
+    
+    if encoding != 'base64':
+        file.write(payload)
+        return
+    
+    # Decode base64 in bounded chunks instead of materializing the whole attachment;
+    # whitespace is dropped so each decoded slice stays aligned to 4-character groups
+    pending = b''
+    for start in range(0, len(payload), DECODE_CHUNK_SIZE):
+        chunk = pending + payload[start:start + DECODE_CHUNK_SIZE].translate(None, b' \t\r\n')
+        usable = len(chunk) - len(chunk) % 4
+        file.write(binascii.a2b_base64(chunk[:usable]))
+        pending = chunk[usable:]
+    
+    if pending:
+        # Tolerate missing padding like Message.get_payload(decode=True) does
+        file.write(binascii.a2b_base64(pending + b'=' * (-len(pending) % 4)))
+
+
+def _preallocate(file, size: int):
+    """Reserve disk space for a file about to be written, where supported"""
+    if size <= DECODE_CHUNK_SIZE or not hasattr(os, 'posix_fallocate'):
+        return
+    
+    try:
+        os.posix_fallocate(file.fileno(), 0, size)
+    except OSError:
+        pass
+
+
+def _param_value(params: Any, name: str) -> Optional[str]:
+    """Look up a parameter in a BODYSTRUCTURE (key value ...) list, including RFC 2231 forms"""
+    if not isinstance(params, list):
+        return None
+    
+    pairs = [
+        (key.decode(errors='replace').lower(), value.decode('utf-8', errors='replace'))
+        for key, value in zip(params[::2], params[1::2])
+        if isinstance(key, bytes) and isinstance(value, bytes)
+    ]
+    
+    # decode_params merges name*0*/name*1* continuations and decodes name*=charset''value;
+    # it passes its first pair through untouched, so prepend a placeholder
+    for key, value in decode_params([('', '')] + pairs)[1:]:
+        if key == name:
+            if isinstance(value, tuple):
+                value = (value[0], value[1], unquote(value[2]))
+            return collapse_rfc2231_value(value)
+    return None
+
+
+def _part_filename(part: List) -> Optional[str]:
+    """Return the attachment filename of a BODYSTRUCTURE part, like Message.get_filename()"""
+    # Extension data starts after the basic fields (plus line count / envelope for text and message parts)
+    content_type = _part_type(part)
+    if content_type == 'message/rfc822':
+        disposition_index = 11
+    elif content_type.startswith('text/'):
+        disposition_index = 9
+    else:
+        disposition_index = 8
+    
+    if len(part) > disposition_index and isinstance(part[disposition_index], list):
+        disposition = part[disposition_index]
+        if len(disposition) > 1:
+            filename = _param_value(disposition[1], 'filename')
+            if filename:
+                return _decode_header_value(filename)
+    
+    name = _param_value(part[2] if len(part) > 2 else None, 'name')
+    return _decode_header_value(name) if name else None
+
+
+def _has_buffered_data(mail: imaplib.IMAP4_SSL) -> bool:
+    """Whether mail.readline() has bytes to return without waiting on the network"""
+    # peek() answers from imaplib's read buffer, or from TLS's decrypted bytes via a
+    # non-blocking socket read; select() on the socket sees neither
+    timeout = mail.sock.gettimeout()
+    mail.sock.setblocking(False)
+    try:
+        return bool(mail.file.peek(1))
+    except (BlockingIOError, ssl.SSLWantReadError):
+        return False
+    finally:
+        mail.sock.settimeout(timeout)
+
+
 class GmailDownloader:
     """Downloads invoice attachments from Gmail"""
     
+    # Set once the input directory has been created in this process
+    _input_dir_ready = False
+    
     def __init__(self, email_config: Dict[str, Any] = None):
         self.config = email_config or EMAIL_CONFIG
         self.input_dir = Path(INPUT_DIR)
-        self.input_dir.mkdir(exist_ok=True)
+        
+        if not GmailDownloader._input_dir_ready:
+            self.input_dir.mkdir(exist_ok=True)
+            GmailDownloader._input_dir_ready = True
         
         # Invoice search patterns - focus on subject/title keywords
-        self.invoice_keywords = [
-            'invoice', 'bill', 'receipt', 'statement', 'payment',
-            'INV-', 'INVOICE-', 'BILL-', 'RECEIPT-', 'PAYMENT-',
-            'invoice #', 'bill #', 'receipt #', 'statement #',
-            'invoice number', 'bill number', 'receipt number',
-            'monthly invoice', 'monthly bill', 'monthly statement',
-            'quarterly invoice', 'quarterly bill', 'quarterly statement',
-            'annual invoice', 'annual bill', 'annual statement',
-            'service invoice', 'service bill', 'service receipt',
-            'consulting invoice', 'consulting bill',
-            'development invoice', 'development bill',
-            'software invoice', 'software bill',
-            'maintenance invoice', 'maintenance bill',
-            'support invoice', 'support bill'
-        ]
+        # Matched case-insensitively as substrings, so longer phrases such as
+        # 'monthly invoice' or 'RECEIPT-' are already covered by these terms
+        self.invoice_keywords = frozenset({
+            'invoice', 'bill', 'receipt', 'statement', 'payment', 'inv-'
+        })
+        self._invoice_re = re.compile(
+            '|'.join(re.escape(keyword) for keyword in sorted(self.invoice_keywords)), re.IGNORECASE
+        )
         
         # Supported attachment extensions
-        self.supported_extensions = [
+        self.supported_extensions = frozenset({
             '.pdf', '.xlsx', '.xls', '.docx', '.doc'
-        ]
+        })
+        
+        # Parallel IMAP connections used for attachment downloads
+        self.max_connections = max(1, min(self.config.get('max_connections', 4), GMAIL_MAX_CONNECTIONS))
+        
+        # Download manifest (input_dir/manifest.jsonl), opened on first write; shared by the download threads
+        self._manifest = None
+        self._manifest_lock = threading.Lock()
+        
+        # Attachment files written during the current run, used to skip duplicates across threads
+        self._saved_files = set()
+        self._saved_files_lock = threading.Lock()
     
     # def connect_to_gmail(self) -> imaplib.IMAP4_SSL:
     def connect_to_gmail(self):
@@ -68,63 +395,94 @@ class GmailDownloader:
             raise EmailError(f"Gmail connection failed: {str(e)}")
     
     # def search_invoices(self, mail: imaplib.IMAP4_SSL, days_back: int = 30) -> List[str]:
-    def search_invoices(self, mail: imaplib.IMAP4_SSL, days_back: int = 30):
-        """Search for emails containing invoices based on subject/title"""
+    def search_invoices(self, mail: imaplib.IMAP4_SSL, days_back: int = 30, uid_range: Optional[str] = None):
+        """Search for emails containing invoices based on subject/title
+        
+        Returns (email_id, info) pairs, where info holds the subject, from and date
+        headers plus the supported attachment parts, so downloads need no refetch.
+        """
         try:
-            logger.info(f"Searching for invoice emails from last {days_back} days...")
-            
-            # Select inbox
-            mail.select('INBOX')
-            
-            # Calculate date range
-            date_since = (datetime.now() - timedelta(days=days_back)).strftime('%d-%b-%Y')
+            # Select inbox (kept selected on long-lived connections)
+            if mail.state != 'SELECTED':
+                mail.select('INBOX')
+            
+            if uid_range:
+                # Only messages that arrived since the last scan
+                logger.info(f"Searching for invoice emails with UIDs {uid_range}...")
+                search_criteria = f'(UID {uid_range})'
+            else:
+                logger.info(f"Searching for invoice emails from last {days_back} days...")
+                
+                # Calculate date range
+                date_since = (datetime.now() - timedelta(days=days_back)).strftime('%d-%b-%Y')
+                
+                # Search criteria
+                search_criteria = f'(SINCE "{date_since}")'
             
-            # Search criteria
-            search_criteria = f'(SINCE "{date_since}")'
+            # Let the server drop mail that can't match before anything is fetched
+            search_criteria = self._build_search_criteria(mail, search_criteria)
             
             # Search for emails
-            status, message_numbers = mail.search(None, search_criteria)
+            status, message_uids = mail.uid('SEARCH', None, search_criteria)
             
             if status != 'OK':
                 raise EmailError("Failed to search emails")
             
-            email_ids = message_numbers[0].split()
+            email_ids = message_uids[0].split()
             invoice_emails = []
             
             logger.info(f"Found {len(email_ids)} emails to check")
             
-            # Check each email for invoice content based on subject
-            for email_id in email_ids:
+            # Fetch only subjects and MIME structure, in batches, instead of one full message per round-trip
+            for batch in _chunked(email_ids, FETCH_BATCH_SIZE):
                 try:
-                    # Fetch email
-                    status, msg_data = mail.fetch(email_id, '(RFC822)')
+                    status, msg_data = mail.uid(
+                        'FETCH', _message_set(batch), '(BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (SUBJECT FROM DATE)])'
+                    )
                     
                     if status != 'OK':
                         continue
                     
-                    email_body = msg_data[0][1]
-                    email_message = email.message_from_bytes(email_body)
-                    
-                    # Get email subject (title)
-                    subject = email_message.get('subject', '').lower()
+                    messages = _parse_fetch_response(msg_data)
                     
-                    # Check if subject contains invoice keywords
-                    is_invoice_email = any(keyword in subject for keyword in self.invoice_keywords)
-                    
-                    # Check for attachments as secondary criteria
-                    has_attachments = self._has_supported_attachments(email_message)
-                    
-                    # Primary detection: Subject contains invoice keywords
-                    # Secondary detection: Has supported attachments (in case subject is generic)
-                    if is_invoice_email or has_attachments:
-                        invoice_emails.append(email_id)
-                        logger.info(f"Found invoice email: {email_message.get('subject', 'No Subject')}")
-                        logger.info(f"  - Subject keywords detected: {is_invoice_email}")
-                        logger.info(f"  - Has attachments: {has_attachments}")
-                        
                 except Exception as e:
-                    logger.warning(f"Error processing email {email_id}: {str(e)}")
+                    logger.warning(f"Error fetching emails {batch[0]}-{batch[-1]}: {str(e)}")
                     continue
+                
+                for email_id, items in messages.items():
+                    try:
+                        email_message = _HEADER_PARSER.parsebytes(_get_header_section(items))
+                        
+                        # Get email subject (title)
+                        subject = _decode_header_value(email_message.get('subject', ''))
+                        
+                        # Check if subject contains invoice keywords
+                        is_invoice_email = bool(self._invoice_re.search(subject))
+                        
+                        # Check for attachments as secondary criteria
+                        try:
+                            attachments = self._find_supported_attachments(items.get('BODYSTRUCTURE'))
+                        except Exception as e:
+                            logger.warning(f"Error checking attachments: {str(e)}")
+                            attachments = []
+                        has_attachments = bool(attachments)
+                        
+                        # Primary detection: Subject contains invoice keywords
+                        # Secondary detection: Has supported attachments (in case subject is generic)
+                        if is_invoice_email or has_attachments:
+                            invoice_emails.append((email_id, {
+                                'subject': subject or 'Unknown',
+                                'from': email_message.get('from', 'Unknown'),
+                                'date': email_message.get('date', 'Unknown'),
+                                'attachments': attachments
+                            }))
+                            logger.info(f"Found invoice email: {subject or 'No Subject'}")
+                            logger.info(f"  - Subject keywords detected: {is_invoice_email}")
+                            logger.info(f"  - Has attachments: {has_attachments}")
+                            
+                    except Exception as e:
+                        logger.warning(f"Error processing email {email_id}: {str(e)}")
+                        continue
             
             logger.info(f"Found {len(invoice_emails)} potential invoice emails")
             return invoice_emails
@@ -133,54 +491,67 @@ class GmailDownloader:
             logger.error(f"Error searching for invoices: {str(e)}")
             raise EmailError(f"Failed to search invoices: {str(e)}")
     
-    def _has_supported_attachments(self, email_message) -> bool:
-        """Check if email has supported attachments"""
-        try:
-            for part in email_message.walk():
-                if part.get_content_maintype() == 'multipart':
-                    continue
-                
-                filename = part.get_filename()
-                if filename:
-                    file_ext = Path(filename).suffix.lower()
-                    if file_ext in self.supported_extensions:
-                        return True
-            
-            return False
-            
-        except Exception as e:
-            logger.warning(f"Error checking attachments: {str(e)}")
-            return False
+    def _build_search_criteria(self, mail: imaplib.IMAP4_SSL, base_criteria: str) -> str:
+        """Combine base criteria with server-side subject keyword filters where they can't lose matches"""
+        # Gmail (X-GM-EXT-1) matches SUBJECT and X-GM-RAW terms as whole words, not substrings, so it
+        # would drop subjects self._invoice_re accepts ("Billing", "Invoices", "INV-2002"); leave the
+        # filtering to the client and search by date/UID only
+        if 'X-GM-EXT-1' in mail.capabilities:
+            return base_criteria
+        
+        # RFC 3501 SUBJECT keys are case-insensitive substring matches, like self._invoice_re.
+        # Plain SEARCH can't test for attachments, so generic-subject mail with a supported
+        # attachment is not kept on these servers
+        keys = [f'SUBJECT "{keyword}"' for keyword in sorted(self.invoice_keywords)]
+        
+        # OR takes exactly two keys, so nest them: OR a OR b c
+        keyword_criteria = keys[-1]
+        for key in reversed(keys[:-1]):
+            keyword_criteria = f'OR {key} {keyword_criteria}'
+        
+        return f'({base_criteria} {keyword_criteria})'
     
-    # def download_attachments(self, mail: imaplib.IMAP4_SSL, email_ids: List[str]) -> List[str]:
-    def download_attachments(self, mail: imaplib.IMAP4_SSL, email_ids: List[str]):
-        """Download attachments from invoice emails"""
+    def _find_supported_attachments(self, bodystructure) -> List[Dict[str, Any]]:
+        """List the MIME parts of a BODYSTRUCTURE that are supported attachments"""
+        attachments = []
+        
+        for section, part in _iter_body_parts(bodystructure):
+            filename = _part_filename(part)
+            if not filename:
+                continue
+            
+            # Check if it's a supported file type
+            file_ext = Path(filename).suffix.lower()
+            if file_ext not in self.supported_extensions:
+                logger.debug(f"Skipping unsupported file: {filename}")
+                continue
+            
+            attachments.append({
+                'section': section,
+                'filename': filename,
+                'extension': file_ext,
+                'encoding': _part_encoding(part),
+                'size': _part_size(part)
+            })
+        
+        return attachments
+    
+    def download_attachments(self, mail: imaplib.IMAP4_SSL, invoice_emails: List[Tuple[bytes, Dict[str, Any]]],
+                             run_ts: Optional[str] = None) -> List[str]:
+        """Download attachments from invoice emails found by search_invoices"""
         downloaded_files = []
+        run_ts = run_ts or datetime.now().strftime("%Y%m%d_%H%M%S")
         
         try:
-            logger.info(f"Downloading attachments from {len(email_ids)} emails...")
+            logger.info(f"Downloading attachments from {len(invoice_emails)} emails...")
             
-            for email_id in email_ids:
+            for email_id, info in invoice_emails:
                 try:
-                    # Fetch email
-                    status, msg_data = mail.fetch(email_id, '(RFC822)')
-                    
-                    if status != 'OK':
-                        continue
-                    
-                    email_body = msg_data[0][1]
-                    email_message = email.message_from_bytes(email_body)
+                    logger.info(f"Processing email: {info['subject']}")
                     
-                    # Get email metadata
-                    subject = email_message.get('subject', 'Unknown')
-                    from_email = email_message.get('from', 'Unknown')
-                    date = email_message.get('date', 'Unknown')
-                    
-                    logger.info(f"Processing email: {subject}")
-                    
-                    # Download attachments
+                    # Fetch only the attachment parts found during search
                     attachment_files = self._download_email_attachments(
-                        email_message, subject, from_email, date
+                        mail, email_id, info['attachments'], info['subject'], info['from'], info['date'], run_ts
                     )
                     
                     downloaded_files.extend(attachment_files)
@@ -196,47 +567,137 @@ class GmailDownloader:
             logger.error(f"Error downloading attachments: {str(e)}")
             raise EmailError(f"Failed to download attachments: {str(e)}")
     
-    def _download_email_attachments(self, email_message, subject: str, from_email: str, date: str) -> List[str]:
-        """Download attachments from a single email"""
+    def download_attachments_parallel(self, mail: imaplib.IMAP4_SSL, invoice_emails: List[Tuple[bytes, Dict[str, Any]]],
+                                      run_ts: Optional[str] = None) -> Tuple[List[str], List[bytes]]:
+        """Download attachments with invoice_emails sharded across several IMAP connections
+        
+        Returns the downloaded files and the UIDs of the emails whose shard completed
+        """
+        num_connections = min(self.max_connections, len(invoice_emails))
+        run_ts = run_ts or datetime.now().strftime("%Y%m%d_%H%M%S")
+        
+        if num_connections <= 1:
+            downloaded_files = self.download_attachments(mail, invoice_emails, run_ts)
+            return downloaded_files, [email_id for email_id, _ in invoice_emails]
+        
+        logger.info(f"Downloading attachments over {num_connections} connections...")
+        
+        # Contiguous shards so the combined file list keeps the original email order
+        shard_size = -(-len(invoice_emails) // num_connections)
+        shards = list(_chunked(invoice_emails, shard_size))
+        
+        downloaded_files = []
+        processed_ids = []
+        with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+            # The first shard reuses the already-selected primary connection,
+            # so no more than max_connections are open at once
+            futures = [executor.submit(self._download_shard, shards[0], run_ts, mail)]
+            futures += [executor.submit(self._download_shard, shard, run_ts) for shard in shards[1:]]
+            
+            for future in futures:
+                shard_files, shard_ids = future.result()
+                downloaded_files.extend(shard_files)
+                processed_ids.extend(shard_ids)
+        
+        return downloaded_files, processed_ids
+    
+    def _download_shard(self, invoice_emails: List[Tuple[bytes, Dict[str, Any]]], run_ts: str,
+                        mail: Optional[imaplib.IMAP4_SSL] = None) -> Tuple[List[str], List[bytes]]:
+        """Download attachments for one shard of emails, on its own connection unless mail is given
+        
+        Returns the downloaded files and the shard's UIDs, or two empty lists if the shard failed
+        """
+        # Errors stay within the shard so the other shards' files are still reported
+        own_connection = mail is None
+        if own_connection:
+            try:
+                mail = self.connect_to_gmail()
+            except Exception as e:
+                logger.error(f"Error connecting shard of {len(invoice_emails)} emails: {str(e)}")
+                return [], []
+        
+        try:
+            if own_connection:
+                mail.select('INBOX')
+            downloaded_files = self.download_attachments(mail, invoice_emails, run_ts)
+            return downloaded_files, [email_id for email_id, _ in invoice_emails]
+            
+        except Exception as e:
+            logger.error(f"Error downloading shard of {len(invoice_emails)} emails: {str(e)}")
+            return [], []
+            
+        finally:
+            if own_connection:
+                try:
+                    mail.close()
+                    mail.logout()
+                except Exception as e:
+                    logger.warning(f"Error closing shard connection: {str(e)}")
+    
+    def _download_email_attachments(self, mail: imaplib.IMAP4_SSL, email_id: bytes, attachments: List[Dict[str, Any]],
+                                    subject: str, from_email: str, date: str, run_ts: str) -> List[str]:
+        """Download the given attachment parts of a single email"""
         downloaded_files = []
         
         try:
             # Create a safe filename from subject
-            safe_subject = re.sub(r'[^\w\s-]', '', subject)
-            safe_subject = re.sub(r'[-\s]+', '-', safe_subject)
+            safe_subject = _SEPARATORS_RE.sub('-', _UNSAFE_CHARS_RE.sub('', subject))
             safe_subject = safe_subject[:50]  # Limit length
             
-            # Process each part of the email
-            for part in email_message.walk():
-                if part.get_content_maintype() == 'multipart':
-                    continue
-                
-                filename = part.get_filename()
-                if not filename:
-                    continue
-                
-                # Check if it's a supported file type
-                file_ext = Path(filename).suffix.lower()
-                if file_ext not in self.supported_extensions:
-                    logger.debug(f"Skipping unsupported file: {filename}")
-                    continue
-                
-                # Create unique filename
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                base_name = Path(filename).stem
-                new_filename = f"{safe_subject}_{base_name}_{timestamp}{file_ext}"
-                file_path = self.input_dir / new_filename
+            # Process each supported attachment part
+            for attachment in attachments:
+                filename = attachment['filename']
+                file_ext = attachment['extension']
                 
                 # Download attachment
                 try:
-                    with open(file_path, 'wb') as f:
-                        f.write(part.get_payload(decode=True))
+                    section = attachment['section']
+                    status, part_data = mail.uid('FETCH', email_id, f'(BODY.PEEK[{section}])')
+                    
+                    if status != 'OK':
+                        logger.error(f"Error downloading {filename}: fetch returned {status}")
+                        continue
+                    
+                    payload = _get_section_literal(part_data, email_id, section)
+                    
+                    # Create unique filename: run timestamp plus a content digest, so attachments
+                    # saved in the same second don't collide and identical ones map to one file
+                    digest = hashlib.sha1(payload).hexdigest()[:8]
+                    base_name = Path(filename).stem
+                    new_filename = f"{safe_subject}_{base_name}_{run_ts}_{digest}{file_ext}"
+                    file_path = self.input_dir / new_filename
+                    
+                    with self._saved_files_lock:
+                        if file_path in self._saved_files:
+                            logger.info(f"Skipping duplicate attachment: {new_filename}")
+                            continue
+                        self._saved_files.add(file_path)
+                    
+                    try:
+                        with open(file_path, 'wb') as f:
+                            # BODYSTRUCTURE reports the encoded size; base64 decodes to ~3/4 of it
+                            expected_size = attachment['size']
+                            if attachment['encoding'] == 'base64':
+                                expected_size = expected_size * 3 // 4
+                            _preallocate(f, expected_size)
+                            
+                            _write_part_payload(f, payload, attachment['encoding'])
+                            
+                            # Drop any preallocated space beyond the decoded data
+                            f.truncate()
+                    except Exception:
+                        # Don't leave a partial, zero-padded file in input_dir, and release
+                        # the name so an identical copy in another email can still be saved
+                        file_path.unlink(missing_ok=True)
+                        with self._saved_files_lock:
+                            self._saved_files.discard(file_path)
+                        raise
                     
                     downloaded_files.append(str(file_path))
                     logger.info(f"Downloaded: {new_filename}")
                     
-                    # Add metadata file
-                    self._create_metadata_file(file_path, subject, from_email, date)
+                    # Record metadata in the manifest
+                    self._record_metadata(file_path, subject, from_email, date)
                     
                 except Exception as e:
                     logger.error(f"Error downloading {filename}: {str(e)}")
@@ -248,31 +709,48 @@ class GmailDownloader:
             logger.error(f"Error processing email attachments: {str(e)}")
             return []
     
-    def _create_metadata_file(self, file_path: Path, subject: str, from_email: str, date: str):
-        """Create metadata file for downloaded attachment"""
+    def _record_metadata(self, file_path: Path, subject: str, from_email: str, date: str):
+        """Append metadata for a downloaded attachment to the manifest"""
         try:
-            metadata_file = file_path.with_suffix('.metadata.txt')
-            
-            with open(metadata_file, 'w', encoding='utf-8') as f:
-                f.write(f"Original Email Subject: {subject}\n")
-                f.write(f"From: {from_email}\n")
-                f.write(f"Date: {date}\n")
-                f.write(f"Downloaded: {datetime.now().isoformat()}\n")
-                f.write(f"File: {file_path.name}\n")
+            entry = json.dumps({
+                'file': file_path.name,
+                'subject': subject,
+                'from': from_email,
+                'date': date,
+                'downloaded': datetime.now().isoformat()
+            }, ensure_ascii=False)
+            
+            with self._manifest_lock:
+                if self._manifest is None:
+                    self._manifest = open(self.input_dir / 'manifest.jsonl', 'a', encoding='utf-8', buffering=MANIFEST_BUFFER_SIZE)
+                self._manifest.write(entry + '\n')
             
         except Exception as e:
-            logger.warning(f"Error creating metadata file: {str(e)}")
+            logger.warning(f"Error recording metadata: {str(e)}")
+    
+    def _close_manifest(self):
+        """Flush and close the manifest if it was opened"""
+        with self._manifest_lock:
+            if self._manifest is not None:
+                try:
+                    self._manifest.close()
+                except Exception as e:
+                    logger.warning(f"Error closing manifest: {str(e)}")
+                self._manifest = None
     
     def mark_emails_as_read(self, mail: imaplib.IMAP4_SSL, email_ids: List[str]):
         """Mark processed emails as read"""
         try:
             logger.info("Marking processed emails as read...")
             
-            for email_id in email_ids:
+            # One STORE per batch of UIDs instead of one round-trip per email
+            for batch in _chunked(email_ids, STORE_BATCH_SIZE):
                 try:
-                    mail.store(email_id, '+FLAGS', '\\Seen')
+                    status, _ = mail.uid('STORE', _message_set(batch), '+FLAGS', '\\Seen')
+                    if status != 'OK':
+                        logger.warning(f"Error marking emails {batch[0]}-{batch[-1]} as read: {status}")
                 except Exception as e:
-                    logger.warning(f"Error marking email {email_id} as read: {str(e)}")
+                    logger.warning(f"Error marking emails {batch[0]}-{batch[-1]} as read: {str(e)}")
             
             logger.info("Emails marked as read")
             
@@ -289,51 +767,185 @@ class GmailDownloader:
             
             try:
                 # Search for invoice emails
-                invoice_email_ids = self.search_invoices(mail, days_back)
+                invoice_emails = self.search_invoices(mail, days_back)
                 
-                if not invoice_email_ids:
-                    logger.info("No invoice emails found")
-                    return {
-                        'success': True,
-                        'emails_found': 0,
-                        'files_downloaded': 0,
-                        'downloaded_files': []
-                    }
+                return self._download_found_invoices(mail, invoice_emails, mark_as_read)
                 
-                # Download attachments
-                downloaded_files = self.download_attachments(mail, invoice_email_ids)
-                
-                # Mark emails as read if requested
-                if mark_as_read:
-                    self.mark_emails_as_read(mail, invoice_email_ids)
+            finally:
+                self._close_manifest()
                 
                 # Disconnect from Gmail
                 mail.close()
                 mail.logout()
                 
-                logger.info("Gmail download process completed successfully")
-                
-                return {
-                    'success': True,
-                    'emails_found': len(invoice_email_ids),
-                    'files_downloaded': len(downloaded_files),
-                    'downloaded_files': downloaded_files
-                }
-                
-            except Exception as e:
-                mail.close()
-                mail.logout()
-                raise e
-                
         except Exception as e:
             logger.error(f"Gmail download process failed: {str(e)}")
             return {
                 'success': False,
                 'error': str(e),
                 'emails_found': 0,
+                'failed_emails': 0,
+                'files_downloaded': 0,
+                'downloaded_files': []
+            }
+    
+    def _download_found_invoices(self, mail: imaplib.IMAP4_SSL, invoice_emails: List[Tuple[bytes, Dict[str, Any]]],
+                                 mark_as_read: bool) -> Dict[str, Any]:
+        """Download attachments for already-found invoice emails and build the result"""
+        if not invoice_emails:
+            logger.info("No invoice emails found")
+            return {
+                'success': True,
+                'emails_found': 0,
+                'failed_emails': 0,
                 'files_downloaded': 0,
                 'downloaded_files': []
             }
+        
+        # Download attachments, all named with this run's timestamp
+        run_ts = datetime.now().strftime("%Y%m%d_%H%M%S")
+        with self._saved_files_lock:
+            self._saved_files.clear()
+        downloaded_files, processed_ids = self.download_attachments_parallel(mail, invoice_emails, run_ts)
+        
+        # Mark emails as read if requested; emails from failed shards stay unread for the next run
+        if mark_as_read and processed_ids:
+            self.mark_emails_as_read(mail, processed_ids)
+        
+        failed_emails = len(invoice_emails) - len(processed_ids)
+        if failed_emails:
+            logger.warning(f"Gmail download process completed with {failed_emails} emails not processed")
+        else:
+            logger.info("Gmail download process completed successfully")
+        
+        return {
+            'success': True,
+            'emails_found': len(invoice_emails),
+            'failed_emails': failed_emails,
+            'files_downloaded': len(downloaded_files),
+            'downloaded_files': downloaded_files
+        }
+    
+    def idle(self, mail: imaplib.IMAP4_SSL, timeout: float = IDLE_TIMEOUT) -> bool:
+        """Block in IMAP IDLE until the server reports new mail or timeout expires"""
+        # An EXISTS that arrived with the previous command has already been collected by imaplib
+        if mail.untagged_responses.pop('EXISTS', None):
+            return True
+        
+        tag = mail._new_tag()
+        
+        try:
+            mail.send(tag + b' IDLE\r\n')
+            
+            # Untagged lines already buffered from before IDLE can precede the continuation
+            new_mail = False
+            while True:
+                line = mail.readline()
+                if not line:
+                    raise EmailError("Connection closed while starting IDLE")
+                if line.startswith(b'+'):
+                    break
+                if line.startswith(tag):
+                    raise EmailError(f"IDLE rejected: {line.decode(errors='replace').strip()}")
+                new_mail = new_mail or line.rstrip().upper().endswith(b' EXISTS')
+            
+            deadline = time.monotonic() + timeout
+            
+            try:
+                while not new_mail:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    
+                    # Wait on the socket unless a response is already buffered
+                    if not _has_buffered_data(mail):
+                        readable, _, _ = select.select([mail.sock], [], [], remaining)
+                        if not readable:
+                            break
+                    
+                    line = mail.readline()
+                    if not line:
+                        raise EmailError("Connection closed during IDLE")
+                    
+                    # Untagged "* <n> EXISTS" means the mailbox grew
+                    new_mail = line.rstrip().upper().endswith(b' EXISTS')
+                
+            finally:
+                # End IDLE and consume everything up to the tagged completion
+                mail.send(b'DONE\r\n')
+                while True:
+                    line = mail.readline()
+                    if not line:
+                        raise EmailError("Connection closed while ending IDLE")
+                    if line.startswith(tag):
+                        break
+            
+        finally:
+            # _new_tag() registers the tag, and only imaplib's own command loop would remove it
+            mail.tagged_commands.pop(tag, None)
+        
+        if not line[len(tag):].strip().upper().startswith(b'OK'):
+            raise EmailError(f"IDLE failed: {line.decode(errors='replace').strip()}")
+        
+        return new_mail
+    
+    def _next_uid(self, mail: imaplib.IMAP4_SSL) -> int:
+        """Return the UID the next message delivered to the selected mailbox will get"""
+        _, data = mail.response('UIDNEXT')
+        if data and data[0]:
+            return int(data[0])
+        
+        # Server did not send UIDNEXT with SELECT; "UID *" matches the highest UID
+        status, data = mail.uid('SEARCH', None, 'UID *')
+        uids = data[0].split() if status == 'OK' and data and data[0] else []
+        return int(uids[-1]) + 1 if uids else 1
+    
+    def watch_invoices(self, mark_as_read: bool = True, idle_timeout: float = IDLE_TIMEOUT):
+        """Keep one connection open and yield a download result whenever invoice emails arrive"""
+        logger.info("Starting Gmail invoice watch...")
+        
+        mail = self.connect_to_gmail()
+        
+        try:
+            if 'IDLE' not in mail.capabilities:
+                raise EmailError("Server does not support IMAP IDLE")
+            
+            mail.select('INBOX')
+            uid_next = self._next_uid(mail)
+            
+            while True:
+                self.idle(mail, idle_timeout)
+                
+                # Check for new UIDs after every IDLE cycle, even on timeout,
+                # in case an EXISTS notification was missed
+                status, data = mail.uid('SEARCH', None, f'UID {uid_next}:*')
+                if status != 'OK':
+                    raise EmailError("Failed to search new emails")
+                
+                # "n:*" still matches the highest UID when nothing newer exists
+                new_uids = [int(uid) for uid in data[0].split() if int(uid) >= uid_next]
+                if not new_uids:
+                    continue
+                
+                uid_range = f"{uid_next}:{max(new_uids)}"
+                uid_next = max(new_uids) + 1
+                
+                invoice_emails = self.search_invoices(mail, uid_range=uid_range)
+                if invoice_emails:
+                    result = self._download_found_invoices(mail, invoice_emails, mark_as_read)
+                    
+                    # Persist this batch's manifest entries before handing back control
+                    self._close_manifest()
+                    yield result
+            
+        finally:
+            self._close_manifest()
+            
+            try:
+                mail.close()
+                mail.logout()
+            except Exception as e:
+                logger.warning(f"Error closing watch connection: {str(e)}")
     
     def test_connection(self) -> bool:
         """Test Gmail connection"""
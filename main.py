@@ -9,13 +9,151 @@ import time
 import re
 import pandas as pd
 import pypdf
+import pypdfium2 as pdfium
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from datetime import datetime
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Iterator
 
 # Import existing email downloader
 from email_downloader import GmailDownloader
-from config import EMAIL_CONFIG
+from config import EMAIL_CONFIG, PROCESSING_CONFIG, ensure_dirs
+
+# Fields extracted from each invoice
+INVOICE_FIELDS = ('invoice_number', 'vendor_name', 'invoice_date', 'invoice_amount', 'due_date', 'payment_status')
+
+# Labelled fields such as "Invoice Number: INV-2002", matched in a single pass
+INVOICE_FIELD_RE = re.compile(
+    r'(?P<field>Invoice Number|Invoice Date|Due Date|Payment Status)[ \t]*:[ \t]*(?P<value>[^\n\r]*)',
+    re.IGNORECASE
+)
+INVOICE_FIELD_MAP = {
+    'invoice number': 'invoice_number',
+    'invoice date': 'invoice_date',
+    'due date': 'due_date',
+    'payment status': 'payment_status'
+}
+
+# Lines containing any of these words are not taken as the vendor name
+SKIP_KEYWORDS = frozenset({
+    'invoice', 'bill', 'date', 'phone', 'email', 'address', 'description', 'qty', 'unit',
+    'total', 'please', 'share', 'form', 'within', 'hours', 'recent', 'infusion'
+})
+SKIP_KEYWORDS_RE = re.compile('|'.join(re.escape(keyword) for keyword in sorted(SKIP_KEYWORDS)), re.IGNORECASE)
+
+# Dollar amounts, and the lines that contain them
+AMOUNT_RE = re.compile(r'\$([\d,]+\.?\d*)')
+AMOUNT_LINE_RE = re.compile(r'^.*\$[\d,].*$', re.MULTILINE)
+
+def iter_pdf_pages(pdf_path: str) -> Iterator[str]:
+    """Yield the text of each PDF page in order, so callers can stop early"""
+    try:
+        # PDFium (native) is much faster than pure-Python parsing
+        pdf = pdfium.PdfDocument(pdf_path)
+        
+    except pdfium.PdfiumError as e:
+        # Fall back to pypdf for files PDFium cannot open
+        print(f"PDFium could not read {Path(pdf_path).name} ({e}), falling back to pypdf")
+        with open(pdf_path, 'rb') as file:
+            pdf_reader = pypdf.PdfReader(file)
+            for page in pdf_reader.pages:
+                yield page.extract_text()
+        return
+    
+    try:
+        for page in pdf:
+            textpage = page.get_textpage()
+            try:
+                yield textpage.get_text_bounded()
+            finally:
+                textpage.close()
+                page.close()
+    finally:
+        pdf.close()
+
+def update_invoice_fields(text: str, invoice_data: Dict[str, Any]):
+    """Fill in invoice fields still missing from invoice_data using one page of text"""
+    # Extract labelled fields (first occurrence wins)
+    for match in INVOICE_FIELD_RE.finditer(text):
+        field = INVOICE_FIELD_MAP[match.group('field').lower()]
+        if invoice_data[field] is None:
+            invoice_data[field] = match.group('value').strip()
+    
+    # Extract vendor name
+    if invoice_data['vendor_name'] is None:
+        for line in text.split('\n'):
+            line = line.strip()
+            if line and len(line) > 3:
+                if not SKIP_KEYWORDS_RE.search(line):
+                    invoice_data['vendor_name'] = line
+                    break
+    
+    # Extract invoice amount (last amount on the first line that has one)
+    if invoice_data['invoice_amount'] is None:
+        for line_match in AMOUNT_LINE_RE.finditer(text):
+            amounts = AMOUNT_RE.findall(line_match.group())
+            try:
+                amount_str = amounts[-1].replace(',', '')
+                invoice_data['invoice_amount'] = float(amount_str)
+                break
+            except ValueError:
+                continue
+
+def write_sheet(writer: pd.ExcelWriter, sheet_name: str, df: pd.DataFrame):
+    """Write a DataFrame to a new sheet in row order (required by xlsxwriter constant_memory mode)"""
+    worksheet = writer.book.add_worksheet(sheet_name)
+    worksheet.write_row(0, 0, list(df.columns))
+    
+    # Missing values become blank cells
+    rows = df.astype(object).where(df.notna(), None)
+    for row_index, row in enumerate(rows.itertuples(index=False), 1):
+        worksheet.write_row(row_index, 0, row)
+
+def extract_invoice_data(pdf_path: str) -> Dict[str, Any]:
+    """Extract invoice data from PDF"""
+    try:
+        print(f"Processing PDF: {Path(pdf_path).name}")
+        
+        # Extract invoice data using simple patterns
+        invoice_data = {
+            'invoice_number': None,
+            'vendor_name': None,
+            'invoice_date': None,
+            'invoice_amount': None,
+            'due_date': None,
+            'payment_status': None,
+            'file_path': Path(pdf_path).name
+        }
+        
+        # Read PDF page by page, stopping once every field is found
+        # (invoice headers are almost always on the first page)
+        for page_text in iter_pdf_pages(pdf_path):
+            update_invoice_fields(page_text, invoice_data)
+            if all(invoice_data[field] is not None for field in INVOICE_FIELDS):
+                break
+        
+        # Normalize payment status
+        status = invoice_data['payment_status']
+        if status is not None:
+            if 'unpaid' in status.lower():
+                invoice_data['payment_status'] = 'Unpaid'
+            elif 'paid' in status.lower():
+                invoice_data['payment_status'] = 'Paid'
+        
+        print(f"Extracted: Invoice={invoice_data['invoice_number']}, Date={invoice_data['invoice_date']}, Amount=${invoice_data['invoice_amount']}, Vendor={invoice_data['vendor_name']}, Due={invoice_data['due_date']}, Status={invoice_data['payment_status']}")
+        return invoice_data
+        
+    except Exception as e:
+        print(f"Error extracting data from {pdf_path}: {e}")
+        return {
+            'invoice_number': None,
+            'vendor_name': None,
+            'invoice_date': None,
+            'invoice_amount': None,
+            'due_date': None,
+            'payment_status': None,
+            'file_path': Path(pdf_path).name
+        }
 
 class SimpleRPA:
     """Simple RPA for invoice processing"""
@@ -39,6 +177,8 @@ class SimpleRPA:
             
             if result['success']:
                 print(f"Downloaded {result['files_downloaded']} files from {result['emails_found']} emails")
+                if result.get('failed_emails'):
+                    print(f"{result['failed_emails']} emails could not be processed and were left unread")
                 return result['downloaded_files']
             else:
                 print(f"Download failed: {result.get('error', 'Unknown error')}")
@@ -48,113 +188,6 @@ class SimpleRPA:
             print(f"Error downloading invoices: {e}")
             return []
     
-    def extract_invoice_data(self, pdf_path: str) -> Dict[str, Any]:
-        """Extract invoice data from PDF"""
-        try:
-            print(f"Processing PDF: {Path(pdf_path).name}")
-            
-            # Read PDF
-            with open(pdf_path, 'rb') as file:
-                pdf_reader = pypdf.PdfReader(file)
-                
-                # Extract text
-                text_content = ""
-                for page in pdf_reader.pages:
-                    text_content += page.extract_text() + "\n"
-            
-            # Extract invoice data using simple patterns
-            invoice_data = {
-                'invoice_number': None,
-                'vendor_name': None,
-                'invoice_date': None,
-                'invoice_amount': None,
-                'due_date': None,
-                'payment_status': None,
-                'file_path': Path(pdf_path).name
-            }
-            
-            lines = text_content.split('\n')
-            
-            # Extract invoice number
-            for line in lines:
-                if 'Invoice Number:' in line:
-                    parts = line.split(':')
-                    if len(parts) > 1:
-                        invoice_data['invoice_number'] = parts[1].strip()
-                        break
-            
-            # Extract vendor name
-            for line in lines:
-                line = line.strip()
-                if line and len(line) > 3:
-                    skip_keywords = ['invoice', 'bill', 'date', 'phone', 'email', 'address', 'description', 'qty', 'unit', 'total', 'please', 'share', 'form', 'within', 'hours', 'recent', 'infusion']
-                    if not any(keyword in line.lower() for keyword in skip_keywords):
-                        invoice_data['vendor_name'] = line
-                        break
-            
-            # Extract invoice date
-            for line in lines:
-                if 'Invoice Date:' in line:
-                    parts = line.split(':')
-                    if len(parts) > 1:
-                        invoice_data['invoice_date'] = parts[1].strip()
-                        break
-            
-            # Extract invoice amount
-            for line in lines:
-                if '$' in line:
-                    amounts = re.findall(r'\$([\d,]+\.?\d*)', line)
-                    if amounts:
-                        try:
-                            amount_str = amounts[-1].replace(',', '')
-                            invoice_data['invoice_amount'] = float(amount_str)
-                            break
-                        except ValueError:
-                            continue
-            
-            # Extract due date
-            for line in lines:
-                if 'Due Date:' in line:
-                    parts = line.split(':')
-                    if len(parts) > 1:
-                        invoice_data['due_date'] = parts[1].strip()
-                        break
-            
-            # Extract payment status
-            payment_status_found = False
-            for line in lines:
-                if 'Payment Status:' in line:
-                    parts = line.split(':')
-                    if len(parts) > 1:
-                        status = parts[1].strip()
-                        if 'unpaid' in status.lower():
-                            invoice_data['payment_status'] = 'Unpaid'
-                        elif 'paid' in status.lower():
-                            invoice_data['payment_status'] = 'Paid'
-                        else:
-                            invoice_data['payment_status'] = status
-                        payment_status_found = True
-                        break
-            
-            # If no payment status found, keep it as None (will be blank in Excel)
-            if not payment_status_found:
-                invoice_data['payment_status'] = None
-            
-            print(f"Extracted: Invoice={invoice_data['invoice_number']}, Date={invoice_data['invoice_date']}, Amount=${invoice_data['invoice_amount']}, Vendor={invoice_data['vendor_name']}, Due={invoice_data['due_date']}, Status={invoice_data['payment_status']}")
-            return invoice_data
-            
-        except Exception as e:
-            print(f"Error extracting data from {pdf_path}: {e}")
-            return {
-                'invoice_number': None,
-                'vendor_name': None,
-                'invoice_date': None,
-                'invoice_amount': None,
-                'due_date': None,
-                'payment_status': None,
-                'file_path': Path(pdf_path).name
-            }
-    
     def process_invoices(self):
         """Main processing function"""
         print("=" * 50)
@@ -173,13 +206,21 @@ class SimpleRPA:
         
         # Step 2: Process each PDF
         print("\nStep 2: Processing PDF files...")
-        invoice_data_list = []
+        max_workers = PROCESSING_CONFIG['max_workers']
         
-        for pdf_file in downloaded_files:
-            invoice_data = self.extract_invoice_data(pdf_file)
-            # Only include if we extracted some data
-            if invoice_data['invoice_number'] or invoice_data['invoice_amount'] or invoice_data['vendor_name']:
-                invoice_data_list.append(invoice_data)
+        if PROCESSING_CONFIG['parallel_processing'] and len(downloaded_files) > 1:
+            # PDF text extraction is CPU-bound, so spread it across processes
+            chunksize = max(1, len(downloaded_files) // (4 * max_workers))
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                extracted = list(executor.map(extract_invoice_data, downloaded_files, chunksize=chunksize))
+        else:
+            extracted = [extract_invoice_data(pdf_file) for pdf_file in downloaded_files]
+        
+        # Only include if we extracted some data
+        invoice_data_list = [
+            invoice_data for invoice_data in extracted
+            if invoice_data['invoice_number'] or invoice_data['invoice_amount'] or invoice_data['vendor_name']
+        ]
         
         if not invoice_data_list:
             print("No invoice data extracted")
@@ -194,21 +235,20 @@ class SimpleRPA:
         df = pd.DataFrame(invoice_data_list)
         
         # Write to Excel
-        with pd.ExcelWriter(excel_file, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Invoice_Data', index=False)
-            
-            # Create summary sheet
-            summary_data = []
-            total_amount = sum(item.get('invoice_amount', 0) for item in invoice_data_list if item.get('invoice_amount'))
-            total_invoices = len(invoice_data_list)
-            unique_vendors = len(set(item.get('vendor_name', '') for item in invoice_data_list if item.get('vendor_name')))
+        # constant_memory flushes each row to disk instead of keeping every cell in memory
+        with pd.ExcelWriter(excel_file, engine='xlsxwriter', engine_kwargs={'options': {'constant_memory': True}}) as writer:
+            write_sheet(writer, 'Invoice_Data', df)
             
-            summary_data.append({'Metric': 'Total Invoices', 'Value': total_invoices})
-            summary_data.append({'Metric': 'Total Amount', 'Value': f"${total_amount:,.2f}"})
-            summary_data.append({'Metric': 'Unique Vendors', 'Value': unique_vendors})
+            # Create summary sheet (vectorized over the DataFrame columns)
+            total_amount = df['invoice_amount'].sum(skipna=True)
+            total_invoices = len(df)
+            unique_vendors = df['vendor_name'].dropna().nunique()
             
-            summary_df = pd.DataFrame(summary_data)
-            summary_df.to_excel(writer, sheet_name='Summary', index=False)
+            summary_df = pd.DataFrame({
+                'Metric': ['Total Invoices', 'Total Amount', 'Unique Vendors'],
+                'Value': [total_invoices, f"${total_amount:,.2f}", unique_vendors]
+            })
+            write_sheet(writer, 'Summary', summary_df)
         
         print(f"Excel report created: {excel_file}")
         print(f"Processed {len(invoice_data_list)} invoices")
@@ -220,6 +260,7 @@ class SimpleRPA:
 
 def main():
     """Main function"""
+    ensure_dirs()
     rpa = SimpleRPA()
     rpa.process_invoices()
 